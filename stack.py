@@ -1,27 +1,72 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
+import collections
+import math
 import re
+import weakref
+
+
+def arg_key(arg):
+    """
+    Return a key telling apart arguments which are equal but behave or
+    print differently, like 1 and 1.0, or 0.0 and -0.0.
+    """
+    if isinstance(arg, float):
+        return (type(arg), arg, math.copysign(1, arg))
+    return (type(arg), arg)
 
 
 class Instr(object):
-    def __init__(self, op, args=None, prefix=None):
-        args = [] if args is None else args
-        prefix = [] if prefix is None else prefix
-        self.op, self.args, self.prefix = op, args, prefix
+    """
+    An immutable instruction. Identical instructions are interned, so
+    `Instr('add') is Instr('add')`, and programs share their instructions.
+    """
+    __slots__ = ('op', 'args', 'prefix', '__weakref__')
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, op, args=None, prefix=None):
+        args = () if args is None else tuple(args)
+        prefix = () if prefix is None else tuple(prefix)
+        key = (op, tuple(arg_key(arg) for arg in args), prefix)
+        try:
+            return cls._interned[key]
+        except KeyError:
+            pass
+        instr = object.__new__(cls)
+        object.__setattr__(instr, 'op', op)
+        object.__setattr__(instr, 'args', args)
+        object.__setattr__(instr, 'prefix', prefix)
+        cls._interned[key] = instr
+        return instr
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Instr is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Instr is immutable")
+
+    def __reduce__(self):
+        return (Instr, (self.op, self.args, self.prefix))
 
     def __repr__(self):
         if self.prefix:
             return 'Instr({!r}, {!r}, {!r})'.format(
-                self.op, self.args, self.prefix)
+                self.op, list(self.args), list(self.prefix))
         elif self.args:
-            return 'Instr({!r}, {!r})'.format(self.op, self.args)
+            return 'Instr({!r}, {!r})'.format(self.op, list(self.args))
         else:
             return 'Instr({!r})'.format(self.op)
 
     def __eq__(self, other):
-        return (self.op == other.op and
-                self.args == other.args and
-                self.prefix == other.prefix)
+        return self is other or (self.op == other.op and
+                                 self.args == other.args and
+                                 self.prefix == other.prefix)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.op, self.args, self.prefix))
 
 
 prefixes = {
@@ -71,10 +116,14 @@ arg_types = {
 }
 
 
-def parse_program(code):
+def parse_program(code, label_indexes=None, start_index=0):
     """
     Take a source code string and yield a sequence of instructions.
 
+    `label_indexes` holds labels defined by earlier code and is updated in
+    place with the labels found in `code`, whose first instruction gets
+    the index `start_index`.
+
     >> list(parse_program('push 1'))
     [Instr('push', [1.0])]
 
@@ -90,8 +139,9 @@ def parse_program(code):
     >>> list(parse_program('♯ +'))
     [Instr('add', [], ['quiet'])]
     """
-    split_program = re.split('\n|;', code)
-    label_indexes = get_label_indexes(split_program);
+    split_program = split_lines(code)
+    label_indexes = get_label_indexes(split_program, label_indexes,
+                                      start_index)
     # Represents ONLY instruction indexes
     # Used to map labels and index numbers.
 
@@ -174,13 +224,16 @@ def parse_program(code):
         yield Instr(op, args, prefix)
 
 
+def split_lines(code):
+    return re.split('\n|;', code)
+
+
 def is_label(label):
     return label[0] == '@'
 
 
-def get_label_indexes(split_program):
-    label_indexes = {}
-    current_index = 0
+def get_label_indexes(split_program, label_indexes=None, current_index=0):
+    label_indexes = {} if label_indexes is None else label_indexes
     for line in split_program:
         parts = line.strip().split()
         if not parts:
@@ -201,96 +254,421 @@ def get_label_indexes(split_program):
 
 
 def eval_program(program):
+    instructions = list(parse_program(program))
+    stack = []
+    execute(instructions, stack, loops=find_counted_loops(instructions))
+    return stack
+
+
+class Session(object):
+    """
+    An interactive session which keeps the stack, instructions and labels
+    between inputs. Each input is parsed on its own, appended to the
+    program so far and executed from where the last input stopped.
+
+    >>> session = Session()
+    >>> session.run('@top; push 1; push 2')
+    [1.0, 2.0]
+    >>> session.run('add')
+    [3.0]
+
+    Labels from earlier inputs can be jumped to. If an input fails to
+    parse or execute, its instructions and labels are dropped, but the
+    stack keeps whatever the input did to it before failing.
+    """
+    def __init__(self):
+        self.stack = []
+        self.instructions = []
+        self.label_indexes = {}
+        self.loops = {}
+        self.current_instr = 0
+
+    def run(self, code):
+        start_index = len(self.instructions)
+        new_labels = [
+            label for label in
+            get_label_indexes(split_lines(code), None, start_index)
+            if label not in self.label_indexes]
+        replaced_loops = {}
+        new_loops = {}
+        succeeded = False
+        try:
+            self.instructions.extend(
+                parse_program(code, self.label_indexes, start_index))
+            new_loops = find_counted_loops(self.instructions, start_index)
+            for start in new_loops:
+                if start in self.loops:
+                    replaced_loops[start] = self.loops[start]
+            self.loops.update(new_loops)
+            self.current_instr = execute(self.instructions, self.stack,
+                                         self.current_instr, self.loops)
+            succeeded = True
+        finally:
+            if not succeeded:
+                del self.instructions[start_index:]
+                for label in new_labels:
+                    self.label_indexes.pop(label, None)
+                for start in new_loops:
+                    del self.loops[start]
+                self.loops.update(replaced_loops)
+        return self.stack
+
+
+def execute(instructions, stack, current_instr=0, loops=None):
+    """
+    Run `instructions` on `stack` in place, starting at `current_instr`,
+    and return the index execution stopped at.
+
+    `loops` maps instruction indexes to the counted loops starting there,
+    as found by `find_counted_loops`, which are run in one step.
+    """
+    loops = {} if loops is None else loops
+    while current_instr < len(instructions):
+        loop = loops.get(current_instr)
+        if loop is not None and run_counted_loop(loop, stack):
+            current_instr = loop.end + 1
+            continue
+
+        current_instr = step(instructions, stack, current_instr)
+    return current_instr
+
+
+def step(instructions, stack, current_instr):
+    """
+    Run the instruction at `current_instr` on `stack` in place and return
+    the index of the next instruction to run.
+    """
+    instr = instructions[current_instr]
+    current_instr += 1
+
+    if 'cond' in instr.prefix:
+        # I think this can be placed in the outer if, but I don't
+        # know it that causes the top value to always get poped
+        if stack.pop() == 0:
+            return current_instr
+
+    elif 'qcond' in instr.prefix:
+        if stack[-1] == 0:
+            return current_instr
+        else:
+            # Fake pop the top value. It will be repushed at the end.
+            qcond_value = stack.pop()
+
+    if instr.op == 'push':
+        stack.append(instr.args[0])
+    elif instr.op == 'pop':
+        stack.pop()
+    elif instr.op in binary_ops:
+        if 'quiet' in instr.prefix:
+            b = stack[-1]
+            a = stack[-2]
+        else:
+            b = stack.pop()
+            a = stack.pop()
+        # b is the top of the stack, and a is the item before it, so
+        # `... ; push 5 ; div` is dividing the result of `...` by 5.
+
+        c = binary_ops[instr.op](b, a)
+        stack.append(c)
+    elif instr.op == 'swap':
+        # `swap` aliased to `swap 1`
+        swap_gap = int(instr.args[0] if instr.args else 1)
+        from_, to = -1, -(1 + swap_gap)
+        stack[from_], stack[to] = stack[to], stack[from_]
+    elif instr.op == 'dup':
+        # `dup` aliases to `dup 1`
+        dup_depth = int(instr.args[0] if instr.args else 1)
+        if dup_depth == 0:
+            return current_instr
+        if dup_depth > len(stack):
+            raise IndexError("Cannot dup {} elements, stack has {}"
+                             .format(dup_depth, len(stack)))
+        stack.extend(stack[-dup_depth:])
+    elif instr.op in unary_ops:
+        if 'quiet' in instr.prefix:
+            operand = stack[-1]
+        else:
+            operand = stack.pop()
+        c = unary_ops[instr.op](operand)
+        stack.append(c)
+    elif instr.op == 'jump':
+        if instr.args:
+            jump_distance = instr.args[0]
+        else:
+            jump_distance = stack[-1]
+            if 'quiet' not in instr.prefix:
+                stack.pop()
+        # We jump 1 less than the argument since we already incremented it
+        # at the beginning of the loop.
+        current_instr += int(jump_distance) - 1
+        if current_instr > len(instructions) or current_instr < 0:
+            raise IndexError
+    elif instr.op == 'to':
+        if instr.args:
+            jump_to = instr.args[0]
+        else:
+            jump_to = stack[-1]
+            if 'quiet' not in instr.prefix:
+                stack.pop()
+        if not float.is_integer(jump_to):
+            raise TypeError("Expected an integer, got a: " + jump_to)
+        current_instr = int(jump_to)
+        if current_instr >= len(instructions) or current_instr <= 0:
+            raise IndexError("Jump address {} out of bounds ({})".format(
+                             current_instr, len(instructions)-1))
+    elif instr.op == 'nop':
+        pass
+    else:
+        raise ValueError('Unknown instruction {}'.format(instr))
+
+    if 'qcond' in instr.prefix:
+        stack.append(qcond_value)
+    return current_instr
+
+
+Event = collections.namedtuple('Event', ['pc', 'op', 'popped', 'pushed'])
+
+
+def iter_eval(program, every=1):
+    """
+    Run a program lazily, yielding an `Event` for every `every`th
+    instruction run, starting with the first. An event has the index and
+    op of the instruction and the change it made to the stack: the
+    instruction removed the top `popped` values and then added `pushed`.
+
+    >>> for event in iter_eval('push 1; push 2; add'):
+    ...     print(event)
+    Event(pc=0, op='push', popped=0, pushed=(1.0,))
+    Event(pc=1, op='push', popped=0, pushed=(2.0,))
+    Event(pc=2, op='add', popped=2, pushed=(3.0,))
+
+    Nothing runs until events are asked for, and instructions between
+    samples run without building events. Unlike `eval_program`, counted
+    loops are run one instruction at a time so that every step is seen.
+    """
+    if isinstance(every, bool) or not isinstance(every, int) or every < 1:
+        raise ValueError(
+            "every must be a positive integer, was {!r}".format(every))
+    return generate_events(program, every)
+
+
+def generate_events(program, every):
     instructions = list(parse_program(program))
     stack = []
     current_instr = 0
+    countdown = 1
     while current_instr < len(instructions):
+        countdown -= 1
+        if countdown:
+            current_instr = step(instructions, stack, current_instr)
+            continue
+        countdown = every
+
         instr = instructions[current_instr]
-        current_instr += 1
+        size = len(stack)
+        unchanged = max(size - stack_depth(instr, stack), 0)
+        pc = current_instr
+        current_instr = step(instructions, stack, current_instr)
+        unchanged = min(unchanged, len(stack))
+        yield Event(pc, instr.op, size - unchanged, tuple(stack[unchanged:]))
 
-        if 'cond' in instr.prefix:
-            # I think this can be placed in the outer if, but I don't
-            # know it that causes the top value to always get poped
-            if stack.pop() == 0:
-                continue
-        
-        elif 'qcond' in instr.prefix:
-            if stack[-1] == 0:
-                continue
-            else:
-                # Fake pop the top value. It will be repushed at the end.
-                qcond_value = stack.pop()
-
-        if instr.op == 'push':
-            stack.append(instr.args[0])
-        elif instr.op == 'pop':
-            stack.pop()
-        elif instr.op in binary_ops:
-            if 'quiet' in instr.prefix:
-                b = stack[-1]
-                a = stack[-2]
-            else:
-                b = stack.pop()
-                a = stack.pop()
-            # b is the top of the stack, and a is the item before it, so
-            # `... ; push 5 ; div` is dividing the result of `...` by 5.
-
-            c = binary_ops[instr.op](b, a)
-            stack.append(c)
-        elif instr.op == 'swap':
-            # `swap` aliased to `swap 1`
-            swap_gap = int(instr.args[0] if instr.args else 1)
-            from_, to = -1, -(1 + swap_gap)
-            stack[from_], stack[to] = stack[to], stack[from_]
-        elif instr.op == 'dup':
-            # `dup` aliases to `dup 1`
-            dup_depth = int(instr.args[0] if instr.args else 1)
-            if dup_depth == 0:
-                continue
-            if dup_depth > len(stack):
-                raise IndexError("Cannot dup {} elements, stack has {}"
-                                 .format(dup_depth, len(stack)))
-            stack.extend(stack[-dup_depth:])
-        elif instr.op in unary_ops:
-            if 'quiet' in instr.prefix:
-                operand = stack[-1]
-            else:
-                operand = stack.pop()
-            c = unary_ops[instr.op](operand)
-            stack.append(c)
-        elif instr.op == 'jump':
-            if instr.args:
-                jump_distance = instr.args[0]
-            else:
-                jump_distance = stack[-1]
-                if 'quiet' not in instr.prefix:
-                    stack.pop()
-            # We jump 1 less than the argument since we already incremented it
-            # at the beginning of the loop.
-            current_instr += int(jump_distance) - 1
-            if current_instr > len(instructions) or current_instr < 0:
-                raise IndexError
-        elif instr.op == 'to':
-            if instr.args:
-                jump_to = instr.args[0]
-            else:
-                jump_to = stack[-1]
-                if 'quiet' not in instr.prefix:
-                    stack.pop()
-            if not float.is_integer(jump_to):
-                raise TypeError("Expected an integer, got a: " + jump_to)
-            current_instr = int(jump_to)
-            if current_instr >= len(instructions) or current_instr <= 0:
-                raise IndexError("Jump address {} out of bounds ({})".format(
-                                 current_instr, len(instructions)-1))
-        elif instr.op == 'nop':
-            pass
-        else:
-            raise ValueError('Unknown instruction {}'.format(instr))
 
-        if 'qcond' in instr.prefix:
-            stack.append(qcond_value)
-    return stack
+def stack_depth(instr, stack):
+    """
+    Return how many values from the top of `stack` `instr` may remove or
+    change.
+    """
+    if 'cond' in instr.prefix or 'qcond' in instr.prefix:
+        if stack and stack[-1] == 0:
+            return 1 if 'cond' in instr.prefix else 0
+        depth = 1
+    else:
+        depth = 0
+    quiet = 'quiet' in instr.prefix
+    if instr.op == 'pop':
+        depth += 1
+    elif instr.op in binary_ops and not quiet:
+        depth += 2
+    elif instr.op in unary_ops and not quiet:
+        depth += 1
+    elif instr.op == 'swap':
+        depth += 1 + int(instr.args[0] if instr.args else 1)
+    elif instr.op in jump_ops and not instr.args and not quiet:
+        depth += 1
+    return depth
+
+
+CountedLoop = collections.namedtuple('CountedLoop', [
+    'start', 'end', 'acc_op', 'acc_arg', 'step', 'test_op', 'test_arg'])
+
+
+# Floats hold every integer up to this exactly, so integer loops within it
+# give the same result whether they are iterated or computed in one go.
+max_exact_int = 2 ** 53
+
+swap_instrs = (Instr('swap'), Instr('swap', [1]))
+dup_instrs = (Instr('dup'), Instr('dup', [1]))
+loop_test_ops = ('eq', 'lt', 'gt', 'le', 'ge')
+
+
+def find_counted_loops(instructions, start_index=0):
+    """
+    Find counted loops closed by an instruction at or after `start_index`
+    and return them keyed by the index of their first instruction.
+
+    A counted loop starts with an accumulator under a counter on the stack
+    and jumps back to its start with `cond jump` while a test of the
+    counter holds. Its body adds to or multiplies the accumulator by a
+    constant (wrapped in swaps), adds or subtracts a constant from the
+    counter, in either order, and then tests the counter against a
+    constant, or just against zero with a bare `dup`:
+
+        @loop
+        swap; push 2; mul; swap
+        push -1; add
+        dup; push 0; gt
+        cond jump @loop
+
+    >>> program = list(parse_program(
+    ...     'push 1; push 10; @loop; swap; push 2; mul; swap; '
+    ...     'push -1; add; dup; cond jump @loop'))
+    >>> find_counted_loops(program)[2].end
+    9
+    """
+    loops = {}
+    for end in range(start_index, len(instructions)):
+        instr = instructions[end]
+        if (instr.op != 'to' or instr.prefix != ('cond',) or
+                not instr.args or not 0 < instr.args[0] < end):
+            continue
+        start = int(instr.args[0])
+        loop = match_counted_loop(instructions[start:end], start, end)
+        if loop is not None:
+            loops[start] = loop
+    return loops
+
+
+def match_counted_loop(body, start, end):
+    def constant(index, ops):
+        push, op = body[index:index + 2]
+        if (push.op != 'push' or push.prefix or
+                op.op not in ops or op.prefix):
+            return None
+        return op.op, push.args[0]
+
+    if len(body) not in (7, 9) or body[6] not in dup_instrs:
+        return None
+    if body[0] in swap_instrs and body[3] in swap_instrs:
+        acc, step = constant(1, ('add', 'mul')), constant(4, ('add', 'sub'))
+    elif body[2] in swap_instrs and body[5] in swap_instrs:
+        acc, step = constant(3, ('add', 'mul')), constant(0, ('add', 'sub'))
+    else:
+        return None
+    if acc is None or step is None:
+        return None
+    step_op, step_arg = step
+    step = step_arg if step_op == 'add' else -step_arg
+
+    test_op = test_arg = None
+    if len(body) == 9:
+        test = constant(7, loop_test_ops)
+        if test is None:
+            return None
+        test_op, test_arg = test
+    return CountedLoop(start, end, acc[0], acc[1], step, test_op, test_arg)
+
+
+def run_counted_loop(loop, stack):
+    """
+    Run `loop` on `stack` in place without iterating. If its result can't
+    be worked out exactly, return False and leave the stack alone so the
+    loop runs normally instead.
+    """
+    if len(stack) < 2:
+        return False
+    acc, counter = stack[-2], stack[-1]
+    values = [acc, counter, loop.acc_arg, loop.step]
+    if loop.test_op is not None:
+        values.append(loop.test_arg)
+    if not all(isinstance(value, float) and value.is_integer() and
+               abs(value) <= max_exact_int for value in values):
+        return False
+
+    if loop.test_op is None:
+        def test(value):
+            return value != 0
+    else:
+        def test(value):
+            return binary_ops[loop.test_op](loop.test_arg, value)
+
+    # Work in ints so nothing rounds, even when `count * step` is large.
+    start, step = int(counter), int(loop.step)
+    count = counted_loop_count(loop, start, test)
+    if count is None:
+        return False
+    # Check the count, since the loop ends the first time the test fails.
+    if test(start + count * step) or (
+            count > 1 and not test(start + (count - 1) * step)):
+        return False
+
+    counter = repeated_sum(counter, loop.step, count)
+    if loop.acc_op == 'add':
+        acc = repeated_sum(acc, loop.acc_arg, count)
+    elif acc == 0 or loop.acc_arg == 0:
+        acc = math.copysign(0.0, math.copysign(1, acc) *
+                            math.copysign(1, loop.acc_arg) ** count)
+    elif abs(loop.acc_arg) > 1 and count > 53:
+        return False
+    else:
+        acc = int(acc) * int(loop.acc_arg) ** count
+        acc = float(acc) if abs(acc) <= max_exact_int else None
+    if acc is None or counter is None:
+        return False
+    stack[-2:] = [acc, counter]
+    return True
+
+
+def repeated_sum(value, step, count):
+    """
+    Return the float `value` with `step` added to it `count` times, or None
+    if that isn't exact. Both must be integers.
+    """
+    total = int(value) + count * int(step)
+    if abs(total) > max_exact_int:
+        return None
+    # Adding floats only gives -0.0 when both sides are -0.0.
+    if (total == 0 and math.copysign(1, value) < 0 and
+            math.copysign(1, step) < 0):
+        return -0.0
+    return float(total)
+
+
+def counted_loop_count(loop, start, test):
+    """
+    Return how many times the body of `loop` runs starting from the integer
+    counter `start`, or None if the loop never ends.
+    """
+    step = int(loop.step)
+    if not test(start + step):
+        return 1
+    elif step == 0:
+        return None
+    elif loop.test_op is None:
+        count, remainder = divmod(-start, step)
+        return count if remainder == 0 and count > 0 else None
+    elif loop.test_op == 'eq':
+        return 2
+
+    limit = int(loop.test_arg)
+    if loop.test_op in ('lt', 'le') and step > 0:
+        distance = limit - start
+    elif loop.test_op in ('gt', 'ge') and step < 0:
+        distance, step = start - limit, -step
+    else:
+        return None
+    if loop.test_op in ('lt', 'gt'):
+        return -(-distance // step)
+    return distance // step + 1
 
 
 jump_ops = {
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 
+import pickle
+
 import stack
 from stack import eval_program, parse_program, Instr
 
@@ -21,6 +23,36 @@ def test_parse():
         list(stack.parse_program('horp; push 0'))
 
 
+def test_instr_interning():
+    # Identical instructions are the same object.
+    program = list(parse_program('push 1; add; push 1; add'))
+    assert program[0] is program[2] is Instr('push', [1.0])
+    assert program[1] is program[3] is Instr('add')
+    assert Instr('add', [], ['quiet']) is Instr('add', prefix=('quiet',))
+    # Equal arguments which print differently are kept apart.
+    assert Instr('push', [1]) == Instr('push', [1.0])
+    assert repr(Instr('push', [1])) == "Instr('push', [1])"
+    assert repr(Instr('push', [1.0])) == "Instr('push', [1.0])"
+    assert len({Instr('push', [1]), Instr('push', [1.0])}) == 1
+    # So are zeros with different signs.
+    zero = Instr('push', [0.0])
+    assert Instr('push', [-0.0]) is not zero
+    assert repr(Instr('push', [-0.0])) == "Instr('push', [-0.0])"
+    assert repr(eval_program('push -0')) == '[-0.0]'
+
+
+def test_instr_immutable():
+    instr = Instr('jump', [2], ['quiet'])
+    assert instr.args == (2,) and instr.prefix == ('quiet',)
+    with pytest.raises(AttributeError):
+        instr.op = 'add'
+    with pytest.raises(AttributeError):
+        instr.extra = 1
+    with pytest.raises(AttributeError):
+        del instr.args
+    assert pickle.loads(pickle.dumps(instr)) is instr
+
+
 def test_parse_quiet():
     expected = [Instr('div', prefix=[]), Instr('add', prefix=['quiet'])]
     assert list(parse_program('div; quiet add')) == expected
@@ -405,3 +437,209 @@ def test_nop():
     assert eval_program('nop') == []
     assert eval_program('∅') == []
 
+
+def test_session():
+    session = stack.Session()
+    assert session.run('push 1; push 2') == [1, 2]
+    assert session.run('add') == [3]
+    assert session.run('') == [3]
+    # Only the new input is executed, the old instructions are kept.
+    assert session.run('push 4\nmul') == [12]
+    assert len(session.instructions) == 5
+    assert session.current_instr == 5
+
+
+@pytest.mark.timeout(1)
+def test_session_labels():
+    session = stack.Session()
+    session.run('push 3; @loop; push -1; add')
+    assert session.run('quiet not; cond jump @end; jump @loop; @end; nop') == [0]
+    # Labels can't be defined twice across inputs either.
+    with pytest.raises(ValueError):
+        session.run('@loop; push 1')
+    with pytest.raises(ValueError):
+        session.run('jump @missing')
+
+
+def test_session_errors():
+    # A failing input is dropped, apart from what it did to the stack.
+    session = stack.Session()
+    session.run('push 1; @label')
+    with pytest.raises(IndexError):
+        session.run('push 2; add; add; @after')
+    assert session.stack == []
+    assert session.instructions == [Instr('push', [1])]
+    assert session.label_indexes == {'@label': 1}
+    assert session.current_instr == 1
+    with pytest.raises(ValueError):
+        session.run('@other; horp')
+    # A clashing label doesn't remove the original.
+    with pytest.raises(ValueError):
+        session.run('@new; @label')
+    assert session.label_indexes == {'@label': 1}
+    assert session.run('@other; push 2') == [2]
+    assert session.label_indexes == {'@label': 1, '@other': 1}
+    # Loops found in a failing input are dropped too.
+    with pytest.raises(IndexError):
+        session.run('@loop; push 1; add; swap; push 1; sub; dup; '
+                    'cond jump @loop; pop; pop; pop')
+    assert session.loops == {}
+
+
+def test_session_interrupted():
+    # Interrupting a runaway loop drops the input that was running.
+    session = stack.Session()
+    session.run('push 1')
+    session.stack = InterruptingList(session.stack)
+    with pytest.raises(KeyboardInterrupt):
+        session.run('@loop; push 1; swap; pop; jump @loop; nop')
+    assert session.instructions == [Instr('push', [1])]
+    assert session.label_indexes == {}
+    assert session.current_instr == 1
+    session.stack = list(session.stack)
+    assert session.run('push 2') == [1, 2]
+
+
+class InterruptingList(list):
+    def __init__(self, values, pushes=1000):
+        list.__init__(self, values)
+        self.pushes = pushes
+
+    def append(self, value):
+        self.pushes -= 1
+        if not self.pushes:
+            raise KeyboardInterrupt
+        list.append(self, value)
+
+
+@pytest.mark.timeout(1)
+def test_counted_loops():
+    # These would take millions of instructions if they were iterated.
+    program = '''
+    push 0
+    push 10000000
+    @loop
+    swap; push 3; add; swap
+    push 1; sub
+    dup; push 0; gt
+    cond jump @loop
+    push 1'''
+    assert eval_program(program) == [30000000, 0, 1]
+    # The counter can be stepped first, and `dup` alone loops until zero.
+    program = '''
+    push 1; push 5000000
+    @loop
+    push -1; add
+    swap; push -1; mul; swap
+    dup; cond jump @loop'''
+    assert eval_program(program) == [1, 0]
+    session = stack.Session()
+    session.run('push 1; push 0; @loop; swap; push 2; mul; swap')
+    assert session.run('push 1; add; dup; push 50; lt; cond jump @loop') \
+        == [2 ** 50, 50]
+
+
+def test_counted_loop_results():
+    # Accelerated loops should match running them one step at a time.
+    for acc_op, step_op, test in [('add', 'add', 'dup; push 7; lt'),
+                                  ('mul', 'sub', 'dup; push -4; ge'),
+                                  ('add', 'sub', 'dup'),
+                                  ('mul', 'add', 'dup; push 2; eq'),
+                                  ('add', 'add', 'dup; push 3; le')]:
+        for start in range(-6, 7):
+            program = ('push 1; push {}; @loop; swap; push 3; {}; swap; '
+                       'push 2; {}; {}; cond jump @loop; nop').format(
+                           start, acc_op, step_op, test)
+            instructions = list(parse_program(program))
+            loops = stack.find_counted_loops(instructions)
+            assert list(loops) == [2]
+            if not stack.run_counted_loop(loops[2], [1.0, float(start)]):
+                continue
+            expected = []
+            stack.execute(instructions, expected)
+            assert eval_program(program) == expected
+
+
+def test_counted_loop_large_range():
+    # Values near the edge of what floats hold exactly shouldn't round.
+    limit = 2 ** 53
+    loop = stack.CountedLoop(2, 10, 'add', 3.0, 3.0, 'lt', limit - 8.0)
+    for start in range(-limit + 1, -limit + 41):
+        values = [float(start), float(start)]
+        assert stack.run_counted_loop(loop, values)
+        count = -(-(limit - 8 - start) // 3)
+        assert values == [start + 3 * count] * 2
+    # Signed zeros come out as they would from iterating.
+    loop = stack.CountedLoop(2, 10, 'add', -0.0, -1.0, None, None)
+    values = [-0.0, 3.0]
+    assert stack.run_counted_loop(loop, values)
+    assert repr(values) == '[-0.0, 0.0]'
+
+
+def test_counted_loop_fallback():
+    # Loops which can't be computed exactly still run normally.
+    program = ('push 1; push 0.5; @loop; swap; push 2; mul; swap; '
+               'push 0.5; add; dup; push 3; lt; cond jump @loop; nop')
+    assert eval_program(program) == [32, 3]
+    loop = stack.find_counted_loops(list(parse_program(program)))[2]
+    assert not stack.run_counted_loop(loop, [1.0, 0.5])
+    # Loops starting with a large accumulator would lose precision.
+    stack_values = [2.0 ** 60, 0.0]
+    assert not stack.run_counted_loop(loop, stack_values)
+    assert stack_values == [2.0 ** 60, 0.0]
+    # Loops which never end aren't shortcut either.
+    assert not stack.run_counted_loop(loop._replace(step=-1.0), [1.0, 0.0])
+    # Other shapes aren't recognised at all.
+    program = '@loop; push 1; swap; push 1; add; swap; dup; cond jump @loop'
+    assert stack.find_counted_loops(list(parse_program(program))) == {}
+
+
+def replay(events):
+    values = []
+    for event in events:
+        if event.popped:
+            del values[-event.popped:]
+        values.extend(event.pushed)
+    return values
+
+
+def test_iter_eval():
+    events = list(stack.iter_eval('push 1; push 2; push 3; swap 2; pop'))
+    assert [event.pc for event in events] == [0, 1, 2, 3, 4]
+    assert [event.op for event in events] == ['push'] * 3 + ['swap', 'pop']
+    assert events[3] == stack.Event(3, 'swap', 3, (3, 2, 1))
+    assert events[4] == stack.Event(4, 'pop', 1, ())
+    # Skipped and conditional instructions still report their changes.
+    events = list(stack.iter_eval('push 5; push 0; cond add; push 1; ?? dup'))
+    assert events[2] == stack.Event(2, 'add', 1, ())
+    assert events[3] == stack.Event(3, 'push', 0, (1,))
+    assert events[4] == stack.Event(4, 'dup', 1, (5, 1))
+    for program in ['push 1; dup; quiet add; push 0; not; swap; jump 1',
+                    'push 10; push 20; push 1; ?? # add',
+                    'push 2; push 3; quiet to; push 1; push 2']:
+        assert replay(stack.iter_eval(program)) == eval_program(program)
+
+
+@pytest.mark.timeout(1)
+def test_iter_eval_sampling():
+    program = '''
+    push 0; push 50000
+    @loop
+    swap; push 1; add; swap
+    push 1; sub
+    dup; cond jump @loop'''
+    # Counted loops are stepped through rather than shortcut, so there are
+    # 2 + 8 * 50000 steps.
+    events = list(stack.iter_eval(program, every=1000))
+    assert len(events) == 401
+    assert events[0] == stack.Event(0, 'push', 0, (0,))
+    assert events[1].pc == 2 + (1000 - 2) % 8
+    # Errors come out when the failing instruction is reached.
+    events = stack.iter_eval('push 1; add')
+    assert next(events) == stack.Event(0, 'push', 0, (1,))
+    with pytest.raises(IndexError):
+        next(events)
+    # Bad sample rates are reported straight away.
+    for every in [0, -1, 2.5, '2', True]:
+        with pytest.raises(ValueError):
+            stack.iter_eval('push 1', every=every)